@@ -0,0 +1,102 @@
+"""
+Local lunar-day computation (Meeus, Astronomical Algorithms ch. 49).
+
+The Rambler page is only scraped to learn the lunar day number and the
+transition times inside a day. The day number is a pure astronomical
+function of the instant and is computed here offline; only the Rambler-
+specific transition times still require scraping. This lets the API serve
+a degraded but correct answer when Rambler is blocked or down.
+"""
+
+import math
+from datetime import datetime, timezone
+
+SYNODIC_MONTH = 29.530588861  # mean days between new moons
+
+_D2R = math.pi / 180.0
+
+
+def _julian_day(dt: datetime) -> float:
+    """
+    Julian Day for an aware datetime.
+    """
+    t = dt.astimezone(timezone.utc)
+    year, month = t.year, t.month
+    day = t.day + (t.hour + t.minute / 60.0 + t.second / 3600.0) / 24.0
+    if month <= 2:
+        year -= 1
+        month += 12
+    a = year // 100
+    b = 2 - a + a // 4
+    return int(365.25 * (year + 4716)) + int(30.6001 * (month + 1)) + day + b - 1524.5
+
+
+def _new_moon_jde(k: float) -> float:
+    """
+    JDE of the k-th mean new moon since 2000-01-06, with the principal
+    periodic corrections from Meeus table 49.1 (day-level accuracy is
+    what we need; the omitted planetary terms are < 0.001 d).
+    """
+    t = k / 1236.85
+    t2 = t * t
+
+    jde = (
+        2451550.09766
+        + SYNODIC_MONTH * k
+        + 0.00015437 * t2
+        - 0.000000150 * t2 * t
+        + 0.00000000073 * t2 * t2
+    )
+
+    e = 1.0 - 0.002516 * t - 0.0000074 * t2
+    m = (2.5534 + 29.10535670 * k - 0.0000014 * t2) * _D2R
+    mp = (201.5643 + 385.81693528 * k + 0.0107582 * t2 + 0.00001238 * t2 * t) * _D2R
+    f = (160.7108 + 390.67050284 * k - 0.0016118 * t2 - 0.00000227 * t2 * t) * _D2R
+    om = (124.7746 - 1.56375588 * k + 0.0020672 * t2 + 0.00000215 * t2 * t) * _D2R
+
+    jde += (
+        -0.40720 * math.sin(mp)
+        + 0.17241 * e * math.sin(m)
+        + 0.01608 * math.sin(2 * mp)
+        + 0.01039 * math.sin(2 * f)
+        + 0.00739 * e * math.sin(mp - m)
+        - 0.00514 * e * math.sin(mp + m)
+        + 0.00208 * e * e * math.sin(2 * m)
+        - 0.00111 * math.sin(mp - 2 * f)
+        - 0.00057 * math.sin(mp + 2 * f)
+        + 0.00056 * e * math.sin(2 * mp + m)
+        - 0.00042 * math.sin(3 * mp)
+        + 0.00042 * e * math.sin(m + 2 * f)
+        + 0.00038 * e * math.sin(m - 2 * f)
+        - 0.00024 * e * math.sin(2 * mp - m)
+        - 0.00017 * math.sin(om)
+        - 0.00007 * math.sin(mp + 2 * m)
+    )
+    return jde
+
+
+def last_new_moon_jd(dt: datetime) -> float:
+    """
+    JDE of the most recent new moon at or before the given instant.
+    """
+    jd = _julian_day(dt)
+    # approximate lunation index, then walk down until we're past it
+    k = math.floor((jd - 2451550.09766) / SYNODIC_MONTH)
+    while _new_moon_jde(k + 1) <= jd:
+        k += 1
+    while _new_moon_jde(k) > jd:
+        k -= 1
+    return _new_moon_jde(k)
+
+
+def lunar_day_number(dt: datetime) -> int:
+    """
+    Traditional lunar day number (1-30) for an aware datetime.
+
+    Approximation: day N covers the N-th civil day since the last new
+    moon. The traditional reckoning starts days at moonrise, so this can
+    be off by one around the boundaries — good enough for the fallback
+    path; exact transition times still come from Rambler.
+    """
+    age = _julian_day(dt) - last_new_moon_jd(dt)
+    return min(int(age) + 1, 30)
@@ -1,235 +1,145 @@
 import os
-import re
-import logging
-from datetime import date, datetime, timedelta, timezone
+import time
+import bisect
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
 from typing import Dict, Any, List, Optional
 
-import requests
-from fastapi import FastAPI, Query, HTTPException
-from cachetools import TTLCache
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
-# ----------------------------
-# LOGGING
-# ----------------------------
-
-logger = logging.getLogger("moon_api")
-logging.basicConfig(level=logging.INFO)
-
-# ----------------------------
-# CONFIG
-# ----------------------------
-
-RAMBLER_URL = "https://horoscopes.rambler.ru/moon/calendar/{calendar_date}/"
-
-HEADERS = {
-    "User-Agent": (
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-        "AppleWebKit/537.36 (KHTML, like Gecko) "
-        "Chrome/126.0.0.0 Safari/537.36"
-    ),
-    "Accept-Language": "ru-RU,ru;q=0.9,en;q=0.8",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    "Referer": "https://horoscopes.rambler.ru/",
-    "Upgrade-Insecure-Requests": "1",
-    "Cache-Control": "no-cache",
-    "Pragma": "no-cache",
-    "Connection": "close",
-}
-
-TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "15"))
-
-CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(60 * 60 * 24)))  # 24h
-cache = TTLCache(maxsize=3000, ttl=CACHE_TTL_SECONDS)
-
-# Moscow timezone fixed (UTC+3)
-MSK = timezone(timedelta(hours=3))
-TZ_NAME = "Europe/Moscow"
-
-RU_MONTH = {
-    "января": 1,
-    "февраля": 2,
-    "марта": 3,
-    "апреля": 4,
-    "мая": 5,
-    "июня": 6,
-    "июля": 7,
-    "августа": 8,
-    "сентября": 9,
-    "октября": 10,
-    "ноября": 11,
-    "декабря": 12,
-}
+import anyio.to_thread
+import orjson
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import ORJSONResponse, Response
+
+from lunar import lunar_day_number
+from lunar_core import (
+    MSK,
+    TTLCache,
+    TZ_NAME,
+    close_client,
+    extract_intervals,
+    fetch_page_text,
+    open_client,
+    prefetch_intervals,
+)
 
 # ----------------------------
-# HTTP SESSION WITH RETRIES
+# APP
 # ----------------------------
 
-def _make_session() -> requests.Session:
-    session = requests.Session()
-    retry = Retry(
-        total=3,
-        backoff_factor=0.7,
-        status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=("GET",),
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
-    return session
-
-
-SESSION = _make_session()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Bound the threadpool used for offloaded CPU work (HTML stripping)
+    # so a burst of cold requests can't fan out unbounded threads.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 64
+    await open_client()
+    # Pay DNS + TCP + TLS once at boot and pre-populate today/tomorrow, so
+    # the first real request neither handshakes nor fetches.
+    today = datetime.now(MSK).date()
+    for offset in (0, 1):
+        asyncio.create_task(prefetch_intervals(today + timedelta(days=offset)))
+    yield
+    await close_client()
 
-# ----------------------------
-# APP
-# ----------------------------
 
 app = FastAPI(
     title="Lunar Day API (Rambler, MSK)",
-    version="3.0.0"
+    version="3.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
+# Fully built payloads, keyed on a 5-second wall-clock window so frequent
+# /lunar-now polls skip pick_current and the payload assembly entirely.
+PAYLOAD_WINDOW_SECONDS = 5
+payload_cache = TTLCache(1000, 60)
+# Pre-serialized /lunar-text bodies for the same windows: repeat hits skip
+# dict construction and JSON encoding entirely.
+payload_bytes_cache = TTLCache(1000, 60)
+
 # ----------------------------
-# PARSING
+# PAYLOAD
 # ----------------------------
 
-# Пример строки:
-# "6 лунный день 24 декабря 11:35 — 25 декабря 11:42"
-# "7 лунный день Рыбы 25 декабря 11:42 — 26 декабря 11:49"
-RE_INTERVAL = re.compile(
-    r"(?P<day>\d{1,2})\s+лунный\s+день"
-    r"(?:\s+(?P<zodiac>[А-Яа-яЁё]+))?"
-    r"\s+(?P<d1>\d{1,2})\s+(?P<m1>[А-Яа-яЁё]+)\s+(?P<t1>\d{1,2}:\d{2})"
-    r"\s*[—-]\s*"
-    r"(?P<d2>\d{1,2})\s+(?P<m2>[А-Яа-яЁё]+)\s+(?P<t2>\d{1,2}:\d{2})",
-    re.IGNORECASE
-)
-
-def fetch_page_text(d: date) -> str:
-    date_str = d.isoformat()
-    url = RAMBLER_URL.format(calendar_date=date_str)
-
-    try:
-        resp = SESSION.get(url, headers=HEADERS, timeout=TIMEOUT)
-    except requests.exceptions.Timeout:
-        logger.exception("Timeout while fetching Rambler for %s", date_str)
-        raise HTTPException(status_code=504, detail="Timeout fetching Rambler")
-    except requests.RequestException as e:
-        logger.exception("Request error while fetching Rambler for %s: %s", date_str, str(e))
-        raise HTTPException(status_code=502, detail=f"Request error: {e}")
-
-    status = resp.status_code
-    html_text = resp.text or ""
-    resp.close()
-
-    logger.info("Rambler fetch %s -> status=%s html_len=%s", url, status, len(html_text))
+def pick_current(intervals: List[Dict[str, Any]], now: datetime) -> Dict[str, Any]:
+    """
+    Pick active interval for current time (MSK).
+    If not inside any, choose the closest future or last.
+    Intervals arrive sorted by start, so a bisect over the precomputed
+    epoch timestamps replaces the linear scan and all datetime arithmetic.
+    """
+    now_ts = now.timestamp()
+    starts = [it["_start_ts"] for it in intervals]
+    idx = bisect.bisect_right(starts, now_ts) - 1
 
-    if status != 200:
-        sample = re.sub(r"\s+", " ", html_text[:1500]).strip()
-        logger.warning("Non-200 from Rambler. status=%s sample=%s", status, sample)
-        raise HTTPException(status_code=502, detail=f"Rambler returned status {status}")
+    # before first -> first
+    if idx < 0:
+        return intervals[0]
 
-    text = re.sub(r"<script[^>]*>.*?</script>", " ", html_text, flags=re.DOTALL | re.IGNORECASE)
-    text = re.sub(r"<style[^>]*>.*?</style>", " ", text, flags=re.DOTALL | re.IGNORECASE)
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
+    # inside interval
+    if now_ts < intervals[idx]["_end_ts"]:
+        return intervals[idx]
 
-    return text
+    # otherwise -> last
+    return intervals[-1]
 
 
-def _month_num(month_ru: str) -> int:
-    m = RU_MONTH.get(month_ru.lower())
-    if not m:
-        raise HTTPException(status_code=502, detail=f"Unknown month word: {month_ru}")
-    return m
+def _public(it: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in it.items() if not k.startswith("_")}
 
 
-def _parse_dt(year: int, day: int, month_ru: str, time_str: str) -> datetime:
+def _computed_payload(d: date, now_msk: datetime) -> Dict[str, Any]:
     """
-    Build timezone-aware datetime in MSK from components.
+    Degraded payload built from the Meeus formula when Rambler is
+    unavailable: the day number is astronomy and computed locally, the
+    Rambler-specific transition times are unknown.
     """
-    m = _month_num(month_ru)
-    hh, mm = time_str.split(":")
-    return datetime(year, m, int(day), int(hh), int(mm), tzinfo=MSK)
+    day_num = lunar_day_number(datetime.combine(d, datetime.min.time(), tzinfo=MSK) + timedelta(hours=12))
+    current = {
+        "day": day_num,
+        "zodiac": None,
+        "startIso": None,
+        "endIso": None,
+        "startTime": None,
+        "endTime": None,
+        "startText": None,
+        "endText": None,
+    }
+    return {
+        "date": d.isoformat(),
+        "tz": TZ_NAME,
+        "nowIso": now_msk.isoformat(),
+        "lines": [f"{day_num} лунный день"],
+        "intervals": [],
+        "current": current,
+        "nextSwitchAtIso": None,
+        "nextSwitchInSeconds": None,
+        "source": "computed",
+    }
 
 
-def extract_intervals(d: date) -> List[Dict[str, Any]]:
-    """
-    Returns 1-2 intervals with ISO datetimes.
-    """
+async def build_payload(d: date) -> Dict[str, Any]:
     date_str = d.isoformat()
-    cache_key = ("intervals_iso", date_str)
-    if cache_key in cache:
-        return cache[cache_key]
-
-    text = fetch_page_text(d)
-    matches = list(RE_INTERVAL.finditer(text))
-
-    if not matches:
-        logger.warning("Could not find lunar intervals for %s. Excerpt: %s", date_str, text[:1200])
-        raise HTTPException(status_code=502, detail="Could not parse Rambler page (blocked or markup changed)")
-
-    intervals: List[Dict[str, Any]] = []
-    for m in matches[:4]:
-        day_num = int(m.group("day"))
-        zodiac = m.group("zodiac")
-        if zodiac:
-            zodiac = zodiac.strip()
-
-        start_dt = _parse_dt(d.year, int(m.group("d1")), m.group("m1"), m.group("t1"))
-        end_dt = _parse_dt(d.year, int(m.group("d2")), m.group("m2"), m.group("t2"))
-
-        intervals.append({
-            "day": day_num,
-            "zodiac": zodiac,
-            "startIso": start_dt.isoformat(),
-            "endIso": end_dt.isoformat(),
-            "startTime": start_dt.strftime("%H:%M"),
-            "endTime": end_dt.strftime("%H:%M"),
-            "startText": f"{m.group('d1')} {m.group('m1')} {m.group('t1')}",
-            "endText": f"{m.group('d2')} {m.group('m2')} {m.group('t2')}",
-        })
-
-    result = intervals[:2]
-    cache[cache_key] = result
-    return result
+    payload_key = (date_str, int(time.time()) // PAYLOAD_WINDOW_SECONDS)
+    if payload_key in payload_cache:
+        return payload_cache[payload_key]
 
-
-def pick_current(intervals: List[Dict[str, Any]], now: datetime) -> Dict[str, Any]:
-    """
-    Pick active interval for current time (MSK).
-    If not inside any, choose the closest future or last.
-    """
-    # Convert to datetime
-    parsed = []
-    for it in intervals:
-        s = datetime.fromisoformat(it["startIso"])
-        e = datetime.fromisoformat(it["endIso"])
-        parsed.append((s, e, it))
-
-    # inside interval
-    for s, e, it in parsed:
-        if s <= now < e:
-            return it
-
-    # if before first -> first
-    if now < parsed[0][0]:
-        return parsed[0][2]
-
-    # otherwise -> last
-    return parsed[-1][2]
-
-
-def build_payload(d: date) -> Dict[str, Any]:
-    intervals = extract_intervals(d)
     now_msk = datetime.now(MSK)
+    try:
+        intervals = await extract_intervals(d)
+    except HTTPException as exc:
+        # Client errors (e.g. date out of range) propagate; upstream
+        # failures (5xx, 429 throttle) fall back to the locally computed
+        # day number, so the UI keeps working instead of seeing an error.
+        if exc.status_code < 500 and exc.status_code != 429:
+            raise
+        payload = _computed_payload(d, now_msk)
+        payload_cache[payload_key] = payload
+        return payload
     current = pick_current(intervals, now_msk)
 
     # next switch = end of current interval (if current end is in the future)
-    current_end = datetime.fromisoformat(current["endIso"])
+    current_end = current["_end_dt"]
     next_switch = current_end if current_end > now_msk else None
 
     # “удобные строки” как ты любишь
@@ -240,16 +150,19 @@ def build_payload(d: date) -> Dict[str, Any]:
         else:
             lines.append(f"{it['day']} лунный день {it['startText']} — {it['endText']}")
 
-    return {
-        "date": d.isoformat(),
+    payload = {
+        "date": date_str,
         "tz": TZ_NAME,
         "nowIso": now_msk.isoformat(),
         "lines": lines,
-        "intervals": intervals,
-        "current": current,
+        "intervals": [_public(it) for it in intervals],
+        "current": _public(current),
         "nextSwitchAtIso": next_switch.isoformat() if next_switch else None,
         "nextSwitchInSeconds": int((next_switch - now_msk).total_seconds()) if next_switch else None,
+        "source": "rambler",
     }
+    payload_cache[payload_key] = payload
+    return payload
 
 # ----------------------------
 # ROUTES
@@ -261,22 +174,32 @@ def health():
 
 
 @app.get("/lunar-text")
-def lunar_text(
+async def lunar_text(
     d: date = Query(..., description="Date in YYYY-MM-DD"),
 ):
-    return build_payload(d)
+    key = (d.isoformat(), int(time.time()) // PAYLOAD_WINDOW_SECONDS)
+    if key in payload_bytes_cache:
+        return Response(content=payload_bytes_cache[key], media_type="application/json")
+
+    payload = await build_payload(d)
+    body = orjson.dumps(payload)
+    payload_bytes_cache[key] = body
+    # Same opportunistic warmup as /lunar-now: the adjacent date is the
+    # most likely follow-up request.
+    asyncio.create_task(prefetch_intervals(d + timedelta(days=1)))
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/lunar-string")
-def lunar_string(
+async def lunar_string(
     d: date = Query(..., description="Date in YYYY-MM-DD"),
 ):
-    payload = build_payload(d)
+    payload = await build_payload(d)
     return "\n".join(payload["lines"])
 
 
 @app.get("/lunar-now")
-def lunar_now(
+async def lunar_now(
     d: date = Query(..., description="Date in YYYY-MM-DD"),
 ):
     """
@@ -288,7 +211,9 @@ def lunar_now(
     - nextSwitchAtIso
     - nextSwitchInSeconds
     """
-    payload = build_payload(d)
+    payload = await build_payload(d)
+    # Warm tomorrow's cache so the next-day UI poll is a cache hit.
+    asyncio.create_task(prefetch_intervals(d + timedelta(days=1)))
     return {
         "date": payload["date"],
         "tz": payload["tz"],
@@ -298,13 +223,20 @@ def lunar_now(
         "nextSwitchInSeconds": payload["nextSwitchInSeconds"],
         "intervals": payload["intervals"],
         "lines": payload["lines"],
+        "source": payload["source"],
     }
 
 
 @app.get("/debug-raw")
-def debug_raw(
+async def debug_raw(
     d: date = Query(..., description="Date in YYYY-MM-DD"),
     n: int = Query(2000, description="How many chars to return"),
+    x_debug_token: Optional[str] = Header(None),
 ):
-    txt = fetch_page_text(d)
+    # Diagnostic endpoint: disabled unless DEBUG_RAW_TOKEN is configured
+    # and presented, so public traffic can't use it to trigger fetches.
+    token = os.getenv("DEBUG_RAW_TOKEN")
+    if not token or x_debug_token != token:
+        raise HTTPException(status_code=403, detail="debug-raw disabled")
+    txt = await fetch_page_text(d)
     return {"date": d.isoformat(), "len": len(txt), "sample": txt[:n]}